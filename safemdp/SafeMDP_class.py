@@ -1,8 +1,23 @@
 from __future__ import division, print_function, absolute_import
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
-from .utilities import max_out_degree
+from .utilities import max_out_degree, _graph_cache
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """Run the decorated function as plain Python if numba is missing."""
+        return lambda func: func
+
+try:
+    from ._bfs import bfs_csr as _bfs_csr_ext
+except ImportError:
+    _bfs_csr_ext = None
 
 __all__ = ['SafeMDP', 'link_graph_and_safe_set', 'reachable_set',
            'returnable_set']
@@ -19,8 +34,9 @@ class SafeMDP(object):
     Parameters
     ----------
     graph: networkx.DiGraph
-        The graph that models the MDP. Each edge has an attribute `safe` in its
-        metadata, which determines the safety of the transition.
+        The graph that models the MDP. It must be linked to the safe set with
+        `link_graph_and_safe_set`, which determines the safety of the
+        transitions.
     gp: GPy.core.GPRegression
         A Gaussian process model that can be used to determine the safety of
         transitions. Exact structure depends heavily on the usecase.
@@ -48,56 +64,454 @@ class SafeMDP(object):
         # GP model
         self.gp = gp
 
+        # Storage for the GP data that add_gp_observations appends to
+        self._X_buf = None
+        self._Y_buf = None
+        self._n = 0
+
         self.graph = graph
-        self.graph_reverse = self.graph.reverse()
+
+        # If safety turns out to be the same in both directions of every
+        # edge, the returnable set does not need to be computed. Set to False
+        # to always compute it.
+        self.check_symmetry = True
 
         num_nodes = self.graph.number_of_nodes()
         num_edges = max_out_degree(graph)
         safe_set_size = (num_nodes, num_edges + 1)
 
-        self.reach = np.empty(safe_set_size, dtype=np.bool)
-        self.G = np.empty(safe_set_size, dtype=np.bool)
+        self.reach = np.empty(safe_set_size, dtype=bool)
+        self.G = np.empty(safe_set_size, dtype=bool)
 
         self.S_hat = S_hat0.copy()
         self.S_hat0 = self.S_hat.copy()
-        self.initial_nodes = self.S_hat0[:, 0].nonzero()[0].tolist()
+        self.initial_nodes = self.S_hat0[:, 0].nonzero()[0].astype(np.int32)
 
     def compute_S_hat(self):
         """Compute the safely reachable set given the current safe_set."""
-        self.reach[:] = False
-        reachable_set(self.graph, self.initial_nodes, out=self.reach)
-
-        self.S_hat[:] = False
-        returnable_set(self.graph, self.graph_reverse, self.initial_nodes,
-                       out=self.S_hat)
-
-        self.S_hat &= self.reach
+        graph = self.graph
+        initial_nodes = _initial_node_array(graph, self.initial_nodes)
+        # Start the cached arrays over if the graph changed
+        _graph_cache(graph)
+
+        # The safety of the edges is shared by both searches
+        safe_flags = _safe_flags(graph)
+        np.copyto(self.reach, False)
+
+        # With symmetric safety every reachable state can also return
+        if self.check_symmetry:
+            mirror = _detect_action_symmetry(graph)
+            if (mirror is not None and
+                    np.array_equal(safe_flags, safe_flags[mirror])):
+                _search(graph, _graph_to_csr(graph)[:3], initial_nodes,
+                        self.reach, True, safe_flags=safe_flags)
+                np.copyto(self.S_hat, self.reach)
+                return
+
+        np.copyto(self.S_hat, False)
+        if _PARALLEL_SEARCH:
+            # The compiled kernels release the GIL, so the returnable set can
+            # be searched in another thread while this one searches the
+            # reachable set
+            returnable = _search_executor().submit(
+                _search, graph, _build_reverse_csr(graph), initial_nodes,
+                self.S_hat, True, safe_flags=safe_flags)
+            _search(graph, _graph_to_csr(graph)[:3], initial_nodes,
+                    self.reach, True, safe_flags=safe_flags)
+            returnable.result()
+
+            # Only states that are reachable can be part of S_hat
+            self.S_hat &= self.reach
+        else:
+            _search(graph, _graph_to_csr(graph)[:3], initial_nodes,
+                    self.reach, True, safe_flags=safe_flags)
+
+            # Only states that are reachable can be part of S_hat
+            _search(graph, _build_reverse_csr(graph), initial_nodes,
+                    self.S_hat, True, mask=self.reach, safe_flags=safe_flags)
 
     def add_gp_observations(self, x_new, y_new):
-        """Add observations to the gp mode."""
+        """Add observations to the gp mode.
+
+        The data is kept in buffers whose capacity doubles when they are
+        full, so that previous observations are not copied on every call.
+        """
+        X = self.gp.X
+        Y = self.gp.Y
+
+        # Start from the data of the gp if it was set elsewhere
+        if (self._X_buf is None or len(X) != self._n or
+                not np.may_share_memory(X, self._X_buf) or
+                not np.may_share_memory(Y, self._Y_buf)):
+            self._X_buf = np.array(X)
+            self._Y_buf = np.array(Y)
+            self._n = len(X)
+
+        x_new = np.reshape(x_new, (-1, X.shape[1]))
+        y_new = np.reshape(y_new, (-1, Y.shape[1]))
+        n = self._n + len(x_new)
+
+        if n > len(self._X_buf):
+            capacity = max(2 * len(self._X_buf), n)
+            X_buf = np.empty((capacity, X.shape[1]), dtype=self._X_buf.dtype)
+            Y_buf = np.empty((capacity, Y.shape[1]), dtype=self._Y_buf.dtype)
+            X_buf[:self._n] = self._X_buf[:self._n]
+            Y_buf[:self._n] = self._Y_buf[:self._n]
+            self._X_buf = X_buf
+            self._Y_buf = Y_buf
+
+        self._X_buf[self._n:n] = x_new
+        self._Y_buf[self._n:n] = y_new
+        self._n = n
+
         # Update GP with observations
-        self.gp.set_XY(np.vstack((self.gp.X,
-                                  x_new)),
-                       np.vstack((self.gp.Y,
-                                  y_new)))
+        self.gp.set_XY(self._X_buf[:n], self._Y_buf[:n])
 
 
 def link_graph_and_safe_set(graph, safe_set):
     """Link the safe set to the graph model.
 
+    The searches cache the structure of the graph. Link the graph again after
+    changing its edges. Copies of the graph and changes to the number of
+    nodes or edges are detected, other changes, such as a different action
+    of an edge, are not.
+
     Parameters
     ----------
     graph: nx.DiGraph()
     safe_set: np.array
         Safe set. For each node the edge (i, j) under action (a) is linked to
-        safe_set[i, a]
+        safe_set[i, a]. Changes to the safe set are seen by the graph as long
+        as they are made in place.
+    """
+    graph.graph['safe_set'] = safe_set
+    graph.graph.pop('cache', None)
+
+
+def _safe_flags(graph):
+    """Return a boolean array that indicates whether each edge is safe.
+
+    Parameters
+    ----------
+    graph: nx.DiGraph
+        A graph that was linked with `link_graph_and_safe_set`.
+
+    Returns
+    -------
+    safe_flags: np.array
+        The safety of the edges, indexed by edge id (see `_graph_to_csr`).
+    """
+    _, _, _, srcs, acts = _graph_to_csr(graph)
+    return graph.graph['safe_set'][srcs, acts]
+
+
+def _detect_action_symmetry(graph):
+    """Find the edge that goes in the opposite direction of each edge.
+
+    The result is cached like the one of `_graph_to_csr`.
+
+    Parameters
+    ----------
+    graph: nx.DiGraph
+        A graph that was linked with `link_graph_and_safe_set`.
+
+    Returns
+    -------
+    mirror: np.array or None
+        The id of the reverse edge of each edge, indexed by edge id. None if
+        some edge has no reverse edge.
+    """
+    cache = _graph_cache(graph, check=False)
+    if 'mirror' in cache:
+        return cache['mirror']
+
+    _, nbrs, _, srcs, _ = _graph_to_csr(graph)
+    mirror = None
+    if len(nbrs):
+        num_nodes = graph.number_of_nodes()
+        keys = srcs.astype(np.int64) * num_nodes + nbrs
+        reverse_keys = nbrs.astype(np.int64) * num_nodes + srcs
+
+        order = np.argsort(keys)
+        pos = np.searchsorted(keys, reverse_keys, sorter=order)
+        mirror = order[np.minimum(pos, len(keys) - 1)]
+        if not np.array_equal(keys[mirror], reverse_keys):
+            mirror = None
+
+    cache['mirror'] = mirror
+    return mirror
+
+
+def _graph_to_csr(graph):
+    """Compute the compressed sparse row representation of a graph.
+
+    The result is cached in `graph.graph` until the graph is linked to a safe
+    set again with `link_graph_and_safe_set`, see `_graph_cache`.
+
+    Parameters
+    ----------
+    graph: nx.DiGraph
+        Directed graph with nodes 0, ..., n - 1 that was linked with
+        `link_graph_and_safe_set`.
+
+    Returns
+    -------
+    indptr: np.array
+        The edges going away from node i are stored at the positions
+        indptr[i]:indptr[i + 1] of the other arrays.
+    nbrs: np.array
+        The node that each edge leads to.
+    eids: np.array
+        The id of each edge, which is equal to its position.
+    srcs: np.array
+        The node that each edge comes from.
+    acts: np.array
+        The action that each edge corresponds to.
+    """
+    cache = _graph_cache(graph, check=False)
+    csr = cache.get('csr')
+    if csr is not None:
+        return csr
+
+    num_nodes = graph.number_of_nodes()
+    indptr = np.zeros(num_nodes + 1, dtype=np.int32)
+    nbrs = []
+    acts = []
+    for node in range(num_nodes):
+        for next_node, data in graph.adj[node].items():
+            nbrs.append(next_node)
+            acts.append(data['action'])
+        indptr[node + 1] = len(nbrs)
+
+    nbrs = np.array(nbrs, dtype=np.int32)
+    acts = np.array(acts, dtype=np.int32)
+    eids = np.arange(len(nbrs), dtype=np.int32)
+    srcs = np.repeat(np.arange(num_nodes, dtype=np.int32), np.diff(indptr))
+
+    csr = cache['csr'] = (indptr, nbrs, eids, srcs, acts)
+    return csr
+
+
+def _build_reverse_csr(graph):
+    """Compute the compressed sparse row representation of the reversed graph.
+
+    The arrays are derived from those of `_graph_to_csr`, so that the
+    reversed graph itself is never built. The result is cached like the one
+    of `_graph_to_csr`.
+
+    Parameters
+    ----------
+    graph: nx.DiGraph
+        Directed graph with nodes 0, ..., n - 1 that was linked with
+        `link_graph_and_safe_set`.
+
+    Returns
+    -------
+    indptr: np.array
+        The edges going into node i are stored at the positions
+        indptr[i]:indptr[i + 1] of the other arrays.
+    srcs: np.array
+        The node that each edge comes from.
+    eids: np.array
+        The id of each edge.
+    """
+    cache = _graph_cache(graph, check=False)
+    csr = cache.get('csr_reverse')
+    if csr is not None:
+        return csr
+
+    indptr, nbrs, eids, srcs, _ = _graph_to_csr(graph)
+    order = np.argsort(nbrs, kind='stable')
+    rev_indptr = np.zeros_like(indptr)
+    rev_indptr[1:] = np.cumsum(np.bincount(nbrs, minlength=len(indptr) - 1))
+
+    csr = cache['csr_reverse'] = (rev_indptr, srcs[order], eids[order])
+    return csr
+
+
+@njit(cache=True, nogil=True)
+def _bfs_csr(indptr, nbrs, eids, safe_flags, initial_nodes, visited_flat,
+             node_offset, mask_flat=None):
+    """Breadth-first search along the safe edges of a CSR graph.
+
+    Parameters
+    ----------
+    indptr, nbrs, eids: np.array
+        The graph, see `_graph_to_csr`.
+    safe_flags: np.array
+        Boolean array that indicates whether each edge is safe, indexed by
+        edge id.
+    initial_nodes: np.array
+        The nodes that the search starts from.
+    visited_flat: bytearray
+        Flags that indicate whether an edge (at its edge id) or a node (at
+        node_offset + node) was visited.
+    node_offset: int
+        The position of the first node in `visited_flat`.
+    mask_flat: np.array, optional
+        Flags with the same layout as `visited_flat`. If given, only edges
+        and nodes that are True in the mask can be visited.
     """
-    for node, next_node in graph.edges():
-        edge = graph[node][next_node]
-        edge['safe'] = safe_set[node:node + 1, edge['action']]
+    # Every node is added at most once after the initial nodes
+    queue = np.empty(len(indptr) - 1 + len(initial_nodes), dtype=np.int32)
+    tail = 0
 
+    # All nodes in the initial set are visited
+    for node in initial_nodes:
+        visited_flat[node_offset + node] = 1
+        queue[tail] = node
+        tail += 1
+
+    head = 0
+    while head < tail:
+        node = queue[head]
+        head += 1
+        for k in range(indptr[node], indptr[node + 1]):
+            edge_id = eids[k]
+            if not safe_flags[edge_id] or visited_flat[edge_id]:
+                continue
+            next_node = nbrs[k]
+            if mask_flat is not None:
+                if not mask_flat[edge_id]:
+                    continue
+                visited_flat[edge_id] = 1
+                if not mask_flat[node_offset + next_node]:
+                    continue
+            else:
+                visited_flat[edge_id] = 1
+            if not visited_flat[node_offset + next_node]:
+                visited_flat[node_offset + next_node] = 1
+                queue[tail] = next_node
+                tail += 1
+
+
+# Whether numba compiled the search kernel
+_BFS_COMPILED = hasattr(_bfs_csr, 'py_func')
+
+# Whether compute_S_hat searches the reachable and returnable sets in
+# parallel. Only the compiled kernels release the GIL.
+_PARALLEL_SEARCH = ((_BFS_COMPILED or _bfs_csr_ext is not None) and
+                    (os.cpu_count() or 1) > 1)
+
+# Worker thread of the parallel search, see `_search_executor`
+_executor = None
+
+
+def _search_executor():
+    """Return the thread pool of the parallel search, created on first use."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1)
+    return _executor
+
+
+def _search(graph, csr, initial_nodes, visited, clear, mask=None,
+            safe_flags=None):
+    """Search the safe edges of a graph and update the visited matrix.
 
-def reachable_set(graph, initial_nodes, out=None):
+    Parameters
+    ----------
+    graph: nx.DiGraph
+        A graph that was linked with `link_graph_and_safe_set`.
+    csr: tuple
+        The arrays (indptr, nbrs, eids) of the CSR representation to search,
+        see `_graph_to_csr` and `_build_reverse_csr`.
+    initial_nodes: np.array
+        Contiguous int32 array of the nodes that the search starts from.
+    visited: np.array
+        Boolean array n_states x (n_actions + 1) that is updated with the
+        visited nodes and state-action pairs.
+    clear: bool
+        Whether `visited` is known to be False everywhere.
+    mask: np.array, optional
+        Boolean array like `visited`. If given, only states and state-action
+        pairs that are True in the mask can be visited.
+    safe_flags: np.array, optional
+        The result of `_safe_flags` for the current safe set. Computed if not
+        given.
+    """
+    # The kernels do not check bounds, so the graph must match `visited`
+    _, _, _, srcs, acts = _graph_to_csr(graph)
+    num_edges = len(acts)
+    if (len(csr[0]) - 1 != visited.shape[0] or
+            (num_edges and acts.max() >= visited.shape[1])):
+        raise IndexError('The graph does not match the shape of the output.')
+
+    # Flags of the state-action pairs by edge id, followed by the states
+    visited_flat = bytearray(num_edges + visited.shape[0])
+    flags = np.frombuffer(visited_flat, dtype=bool)
+    if not clear:
+        flags[:num_edges] = visited[srcs, acts]
+        flags[num_edges:] = visited[:, 0]
+
+    if mask is None:
+        mask_flat = None
+    else:
+        mask_flat = np.empty_like(flags)
+        mask_flat[:num_edges] = mask[srcs, acts]
+        mask_flat[num_edges:] = mask[:, 0]
+
+    indptr, nbrs, eids = csr
+    if safe_flags is None:
+        safe_flags = _safe_flags(graph)
+
+    if _BFS_COMPILED:
+        bfs = _bfs_csr
+    elif _bfs_csr_ext is not None:
+        # The Cython extension takes the flags as byte buffers
+        bfs = _bfs_csr_ext
+        safe_flags = safe_flags.view(np.uint8)
+        if mask_flat is not None:
+            mask_flat = mask_flat.view(np.uint8)
+    else:
+        # Plain Python indexes lists and bytearrays much faster than arrays
+        bfs = _bfs_csr
+        indptr = indptr.tolist()
+        nbrs = nbrs.tolist()
+        eids = eids.tolist()
+        safe_flags = bytearray(safe_flags)
+        initial_nodes = initial_nodes.tolist()
+        if mask_flat is not None:
+            mask_flat = bytearray(mask_flat)
+
+    bfs(indptr, nbrs, eids, safe_flags, initial_nodes, visited_flat,
+        num_edges, mask_flat)
+
+    visited[srcs, acts] = flags[:num_edges]
+    visited[:, 0] = flags[num_edges:]
+
+
+def _initial_node_array(graph, initial_nodes):
+    """Check the initial nodes of a search and convert them to an array.
+
+    The search kernels do not check bounds, so nodes that are not in the
+    graph must be rejected before the search.
+
+    Parameters
+    ----------
+    graph: nx.DiGraph
+        The graph to search.
+    initial_nodes: list or np.array
+        The nodes that the search starts from.
+
+    Returns
+    -------
+    initial_nodes: np.array
+        Contiguous int32 array of the initial nodes.
+    """
+    initial_nodes = np.asarray(initial_nodes)
+    if not initial_nodes.size:
+        raise AttributeError('Set of initial nodes needs to be non-empty.')
+
+    # Check before the conversion, which would wrap around large values
+    if np.any((initial_nodes < 0) |
+              (initial_nodes >= graph.number_of_nodes())):
+        raise IndexError('Initial nodes must be nodes of the graph.')
+    return initial_nodes.astype(np.int32, order='C', casting='same_kind',
+                                copy=False)
+
+
+def reachable_set(graph, initial_nodes, out=None, clear=True):
     """
     Compute the safe, reachable set of a graph
 
@@ -106,14 +520,17 @@ def reachable_set(graph, initial_nodes, out=None):
     graph: nx.DiGraph
         Directed graph. Each edge must have associated action metadata,
         which specifies the action that this edge corresponds to.
-        Each edge has an attribute ['safe'], which is a boolean that
-        indicates safety
-    initial_nodes: list
+        The graph must be linked to a safe set with
+        `link_graph_and_safe_set`, which determines the safety of the edges.
+        Link it again after changing its edges.
+    initial_nodes: list or np.array
         List of the initial, safe nodes that are used as a starting point to
         compute the reachable set.
     out: np.array
-        The array to write the results to. Is assumed to be False everywhere
-        except at the initial nodes
+        The array to write the results to.
+    clear: bool
+        Whether to set `out` to False before the search. Otherwise it is
+        assumed to be False everywhere except at the initial nodes.
 
     Returns
     -------
@@ -122,38 +539,28 @@ def reachable_set(graph, initial_nodes, out=None):
         set.
     """
 
-    if not initial_nodes:
-        raise AttributeError('Set of initial nodes needs to be non-empty.')
+    initial_nodes = _initial_node_array(graph, initial_nodes)
+    # Start the cached arrays over if the graph changed
+    _graph_cache(graph)
 
     if out is None:
         visited = np.zeros((graph.number_of_nodes(),
                             max_out_degree(graph) + 1),
-                           dtype=np.bool)
+                           dtype=bool)
     else:
         visited = out
+        if clear:
+            np.copyto(visited, False)
 
-    # All nodes in the initial set are visited
-    visited[initial_nodes, 0] = True
-
-    stack = list(initial_nodes)
-
-    # TODO: rather than checking if things are safe, specify a safe subgraph?
-    while stack:
-        node = stack.pop(0)
-        # iterate over edges going away from node
-        for _, next_node, data in graph.edges(node, data=True):
-            action = data['action']
-            if not visited[node, action] and data['safe']:
-                visited[node, action] = True
-                if not visited[next_node, 0]:
-                    stack.append(next_node)
-                    visited[next_node, 0] = True
+    _search(graph, _graph_to_csr(graph)[:3], initial_nodes, visited,
+            clear=clear or out is None)
 
     if out is None:
         return visited
 
 
-def returnable_set(graph, reverse_graph, initial_nodes, out=None):
+def returnable_set(graph, reverse_graph, initial_nodes, out=None,
+                   clear=True, mask=None):
     """
     Compute the safe, returnable set of a graph
 
@@ -162,16 +569,25 @@ def returnable_set(graph, reverse_graph, initial_nodes, out=None):
     graph: nx.DiGraph
         Directed graph. Each edge must have associated action metadata,
         which specifies the action that this edge corresponds to.
-        Each edge has an attribute ['safe'], which is a boolean that
-        indicates safety
-    reverse_graph: nx.DiGraph
-        The reversed directed graph, `graph.reverse()`
-    initial_nodes: list
+        The graph must be linked to a safe set with
+        `link_graph_and_safe_set`, which determines the safety of the edges.
+        Link it again after changing its edges.
+    reverse_graph: nx.DiGraph or None
+        Not used, the edges going into each node are derived from `graph`.
+        Kept for backwards compatibility.
+    initial_nodes: list or np.array
         List of the initial, safe nodes that are used as a starting point to
         compute the returnable set.
     out: np.array
-        The array to write the results to. Is assumed to be False everywhere
-        except at the initial nodes
+        The array to write the results to.
+    clear: bool
+        Whether to set `out` to False before the search. Otherwise it is
+        assumed to be False everywhere except at the initial nodes.
+    mask: np.array, optional
+        Boolean array like `out`. If given, the search only passes through
+        states and state-action pairs that are True in the mask. For the
+        reachable set of the same initial nodes, the result is the
+        intersection of the returnable and the reachable set.
 
     Returns
     -------
@@ -180,32 +596,21 @@ def returnable_set(graph, reverse_graph, initial_nodes, out=None):
         set.
     """
 
-    if not initial_nodes:
-        raise AttributeError('Set of initial nodes needs to be non-empty.')
+    initial_nodes = _initial_node_array(graph, initial_nodes)
+    # Start the cached arrays over if the graph changed
+    _graph_cache(graph)
 
     if out is None:
         visited = np.zeros((graph.number_of_nodes(),
                             max_out_degree(graph) + 1),
-                           dtype=np.bool)
+                           dtype=bool)
     else:
         visited = out
+        if clear:
+            np.copyto(visited, False)
 
-    # All nodes in the initial set are visited
-    visited[initial_nodes, 0] = True
-
-    stack = list(initial_nodes)
-
-    # TODO: rather than checking if things are safe, specify a safe subgraph?
-    while stack:
-        node = stack.pop(0)
-        # iterate over edges going into node
-        for _, prev_node in reverse_graph.edges(node):
-            data = graph.get_edge_data(prev_node, node)
-            if not visited[prev_node, data['action']] and data['safe']:
-                visited[prev_node, data['action']] = True
-                if not visited[prev_node, 0]:
-                    stack.append(prev_node)
-                    visited[prev_node, 0] = True
+    _search(graph, _build_reverse_csr(graph), initial_nodes, visited,
+            clear=clear or out is None, mask=mask)
 
     if out is None:
         return visited
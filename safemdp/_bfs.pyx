@@ -0,0 +1,61 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Compiled version of the breadth-first search in `SafeMDP_class._bfs_csr`.
+
+It is only used if numba is not installed. Build it in place with
+
+    cythonize -i safemdp/_bfs.pyx
+"""
+
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
+
+def bfs_csr(const int[::1] indptr, const int[::1] nbrs, const int[::1] eids,
+            const unsigned char[::1] safe_flags, const int[::1] initial_nodes,
+            unsigned char[::1] visited_flat, Py_ssize_t node_offset,
+            const unsigned char[::1] mask_flat=None):
+    """Breadth-first search along the safe edges of a CSR graph.
+
+    See `SafeMDP_class._bfs_csr` for the parameters.
+    """
+    cdef Py_ssize_t num_nodes = indptr.shape[0] - 1
+    cdef Py_ssize_t size = num_nodes + initial_nodes.shape[0]
+    cdef bint masked = mask_flat is not None
+    cdef Py_ssize_t head = 0, tail = 0, i, k
+    cdef int node, next_node, edge_id
+
+    # Every node is added at most once after the initial nodes
+    cdef int *queue = <int *> PyMem_Malloc(size * sizeof(int))
+    if queue == NULL:
+        raise MemoryError()
+
+    with nogil:
+        # All nodes in the initial set are visited
+        for i in range(initial_nodes.shape[0]):
+            node = initial_nodes[i]
+            visited_flat[node_offset + node] = 1
+            queue[tail] = node
+            tail += 1
+
+        while head < tail:
+            node = queue[head]
+            head += 1
+            for k in range(indptr[node], indptr[node + 1]):
+                edge_id = eids[k]
+                if not safe_flags[edge_id] or visited_flat[edge_id]:
+                    continue
+                next_node = nbrs[k]
+                if masked:
+                    if not mask_flat[edge_id]:
+                        continue
+                    visited_flat[edge_id] = 1
+                    if not mask_flat[node_offset + next_node]:
+                        continue
+                else:
+                    visited_flat[edge_id] = 1
+                if not visited_flat[node_offset + next_node]:
+                    visited_flat[node_offset + next_node] = 1
+                    queue[tail] = next_node
+                    tail += 1
+
+    PyMem_Free(queue)
@@ -34,7 +34,7 @@ def compute_true_safe_set(world_shape, altitude, h):
         Boolean array n_states x (n_actions + 1).
     """
 
-    true_safe = np.zeros((world_shape[0] * world_shape[1], 5), dtype=np.bool)
+    true_safe = np.zeros((world_shape[0] * world_shape[1], 5), dtype=bool)
 
     altitude_grid = altitude.reshape(world_shape)
 
@@ -136,15 +136,17 @@ def compute_S_hat0(s, world_shape, n_actions, altitudes, step_size, h):
         valid_initial_seed = False
         vertical = False
         horizontal = False
+
+        # Branch on scalars rather than on length-1 arrays
+        s = int(np.squeeze(s))
         altitude_prev = altitudes[s]
-        if not isinstance(s, np.ndarray):
-            s = np.array([s])
 
         # Loop through actions
         for action in range(1, n_actions + 1):
 
             # Compute next state to check steepness
-            next_vec_ind = dynamics_vec_ind(s, action, world_shape)
+            next_vec_ind = dynamics_vec_ind(np.array([s]), action,
+                                            world_shape)[0]
             altitude_next = altitudes[next_vec_ind]
 
             if s != next_vec_ind and -np.abs(altitude_prev - altitude_next) / \
@@ -243,7 +245,7 @@ def compute_true_S_hat(graph, safe_set, initial_nodes, reverse_graph=None):
     safe_set: np.array
     initial_nodes: list of int
     reverse_graph: nx.DiGraph
-        graph.reverse()
+        Not used, kept for backwards compatibility.
 
     Returns
     -------
@@ -252,12 +254,8 @@ def compute_true_S_hat(graph, safe_set, initial_nodes, reverse_graph=None):
     """
     graph = graph.copy()
     link_graph_and_safe_set(graph, safe_set)
-    if reverse_graph is None:
-        reverse_graph = graph.reverse()
     reach = reachable_set(graph, initial_nodes)
-    ret = returnable_set(graph, reverse_graph, initial_nodes)
-    ret &= reach
-    return ret
+    return returnable_set(graph, None, initial_nodes, mask=reach)
 
 
 class GridWorld(SafeMDP):
@@ -587,7 +585,7 @@ def states_to_nodes(states, world_shape, step_size):
         The node indices corresponding to the states
     """
     states = np.asanyarray(states)
-    node_indices = np.rint(states / step_size).astype(np.int)
+    node_indices = np.rint(states / step_size).astype(int)
     return node_indices[:, 1] + world_shape[1] * node_indices[:, 0]
 
 
@@ -681,7 +679,9 @@ def shortest_path(source, next_sample, G):
     """
 
     # Extract safe graph
-    safe_edges = [edge for edge in G.edges(data=True) if edge[2]['safe']]
+    safe_set = G.graph['safe_set']
+    safe_edges = [edge for edge in G.edges(data=True)
+                  if safe_set[edge[0], edge[2]['action']]]
     graph_safe = nx.DiGraph(safe_edges)
 
     # Compute shortest path
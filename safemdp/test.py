@@ -1,5 +1,7 @@
 from __future__ import division, print_function, absolute_import
 
+import copy
+import pickle
 import unittest
 import GPy
 import numpy as np
@@ -8,9 +10,10 @@ from numpy.testing import *
 
 from .utilities import *
 
-from safemdp.SafeMDP_class import reachable_set, returnable_set
+from safemdp.SafeMDP_class import reachable_set, returnable_set, SafeMDP
 from safemdp.grid_world import compute_true_safe_set, grid_world_graph
 from .SafeMDP_class import link_graph_and_safe_set
+from . import SafeMDP_class
 
 
 class DifferenceKernelTest(unittest.TestCase):
@@ -86,6 +89,21 @@ class DifferenceKernelTest(unittest.TestCase):
 
         self._check(gp, x1, x2)
 
+    def test_nonstationary(self):
+        """Test the difference kernel for a non-stationary kernel."""
+        kernel = GPy.kern.Linear(input_dim=1)
+        likelihood = GPy.likelihoods.Gaussian(variance=0.005 ** 2)
+        x = np.linspace(0, 1, 5)[:, None]
+        y = 2 * x
+        gp = GPy.core.GP(x, y, kernel, likelihood)
+
+        # Create test points
+        n = 10
+        x1 = np.linspace(0, 1, n)[:, None]
+        x2 = x1 + np.linspace(0, 0.1, n)[::-1, None]
+
+        self._check(gp, x1, x2)
+
 
 class MaxOutDegreeTest(unittest.TestCase):
     def test_all(self):
@@ -109,6 +127,22 @@ class MaxOutDegreeTest(unittest.TestCase):
         graph.add_edge(3, 1)
         assert_(max_out_degree(graph), 3)
 
+    def test_linked(self):
+        """Test the value cached for linked graphs."""
+        graph = grid_world_graph((3, 3))
+        link_graph_and_safe_set(graph, np.ones((9, 5), dtype=bool))
+        assert_equal(max_out_degree(graph), 4)
+
+        # Copies and subgraph views share graph.graph with the graph
+        assert_equal(max_out_degree(graph.subgraph([0, 1, 3])), 2)
+        copy = graph.copy()
+        copy.remove_edge(4, 1)
+        assert_equal(max_out_degree(copy), 3)
+        assert_equal(max_out_degree(graph), 4)
+
+        graph.remove_edge(4, 1)
+        assert_equal(max_out_degree(graph), 3)
+
 
 class ReachableSetTest(unittest.TestCase):
 
@@ -130,9 +164,9 @@ class ReachableSetTest(unittest.TestCase):
 
         self.safe_set = np.ones((self.graph.number_of_nodes(),
                                  max_out_degree(self.graph) + 1),
-                                dtype=np.bool)
+                                dtype=bool)
         link_graph_and_safe_set(self.graph, self.safe_set)
-        self.true = np.zeros(self.safe_set.shape[0], dtype=np.bool)
+        self.true = np.zeros(self.safe_set.shape[0], dtype=bool)
 
     def setUp(self):
         self.safe_set[:] = True
@@ -178,10 +212,44 @@ class ReachableSetTest(unittest.TestCase):
         reachable_set(self.graph, [0], out=out)
         assert_equal(out[:, 0], self.true)
 
+    def test_clear(self):
+        """Test clearing the output"""
+        self.true[:] = [1, 1, 1, 1, 0]
+        out = np.ones_like(self.safe_set)
+        reachable_set(self.graph, [0], out=out)
+        assert_equal(out[:, 0], self.true)
+
+        out[:] = False
+        out[4, 0] = True
+        reachable_set(self.graph, [0], out=out, clear=False)
+        assert_equal(out[:, 0], [1, 1, 1, 1, 1])
+
+    def test_changed_graph(self):
+        """Test a copy of the graph and the graph itself after changes"""
+        reachable_set(self.graph, [0])
+
+        graph = self.graph.copy()
+        graph.remove_edge(0, 1)
+        assert_equal(reachable_set(graph, [0])[:, 0], [1, 0, 0, 0, 0])
+        assert_equal(reachable_set(self.graph, [0])[:, 0], [1, 1, 1, 1, 0])
+
+        self.graph.remove_edge(1, 2)
+        assert_equal(reachable_set(self.graph, [0])[:, 0], [1, 1, 0, 0, 0])
+
     def test_error(self):
         """Check error condition"""
         with assert_raises(AttributeError):
             reachable_set(self.graph, [])
+        with assert_raises(IndexError):
+            reachable_set(self.graph, [5])
+        with assert_raises(IndexError):
+            reachable_set(self.graph, [-1])
+        with assert_raises(IndexError):
+            reachable_set(self.graph, np.array([2 ** 32]))
+        with assert_raises(IndexError):
+            reachable_set(self.graph, [0], out=np.zeros((4, 3), dtype=bool))
+        with assert_raises(IndexError):
+            reachable_set(self.graph, [0], out=np.zeros((5, 2), dtype=bool))
 
 
 class ReturnableSetTest(unittest.TestCase):
@@ -201,13 +269,13 @@ class ReturnableSetTest(unittest.TestCase):
                                    (2, 0),
                                    (4, 1)], action=1)
         self.graph.add_edge(2, 3, action=2)
-        self.graph_rev = self.graph.reverse()
+        self.graph_rev = self.graph.reverse(copy=False)
 
         self.safe_set = np.ones((self.graph.number_of_nodes(),
                                  max_out_degree(self.graph) + 1),
-                                dtype=np.bool)
+                                dtype=bool)
         link_graph_and_safe_set(self.graph, self.safe_set)
-        self.true = np.zeros(self.safe_set.shape[0], dtype=np.bool)
+        self.true = np.zeros(self.safe_set.shape[0], dtype=bool)
 
     def setUp(self):
         self.safe_set[:] = True
@@ -253,10 +321,142 @@ class ReturnableSetTest(unittest.TestCase):
         returnable_set(self.graph, self.graph_rev, [0], out=out)
         assert_equal(out[:, 0], self.true)
 
+    def test_mask(self):
+        """Test restricting the search to the reachable set"""
+        self.safe_set[2, 2] = False
+        reach = reachable_set(self.graph, [0])
+        ret = returnable_set(self.graph, self.graph_rev, [0])
+        masked = returnable_set(self.graph, self.graph_rev, [0], mask=reach)
+        assert_equal(masked[:, 0], [1, 1, 1, 0, 0])
+        assert_equal(masked, ret & reach)
+
     def test_error(self):
         """Check error condition"""
         with assert_raises(AttributeError):
             reachable_set(self.graph, [])
+        with assert_raises(IndexError):
+            returnable_set(self.graph, None, [5])
+        with assert_raises(IndexError):
+            returnable_set(self.graph, None, [-1])
+
+
+class AddGPObservationsTest(unittest.TestCase):
+    """Test the add_gp_observations method."""
+
+    def test(self):
+        """Compare with stacking the data"""
+        graph = grid_world_graph((2, 2))
+        S_hat0 = np.zeros((4, 5), dtype=bool)
+        S_hat0[0, 0] = True
+        link_graph_and_safe_set(graph, np.ones_like(S_hat0))
+
+        x = np.random.rand(10, 2)
+        y = np.random.rand(10, 1)
+        gp = GPy.core.GP(x[:1], y[:1], GPy.kern.RBF(input_dim=2),
+                         GPy.likelihoods.Gaussian())
+        mdp = SafeMDP(graph, gp, S_hat0, 0, 0)
+
+        for i in range(1, 10, 2):
+            mdp.add_gp_observations(x[i:i + 2], y[i:i + 2])
+            assert_equal(gp.X, x[:i + 2])
+            assert_equal(gp.Y, y[:i + 2])
+
+        # Data that was set directly on the gp
+        gp.set_XY(x[:2], y[:2])
+        mdp.add_gp_observations(x[5:6], y[5:6])
+        assert_equal(gp.X, x[[0, 1, 5]])
+        assert_equal(gp.Y, y[[0, 1, 5]])
+
+
+class ComputeSHatTest(unittest.TestCase):
+    """Test the compute_S_hat method."""
+
+    def _mdp(self, blocked):
+        """Create an MDP on a 4 x 4 grid world that starts in state 5.
+
+        Parameters
+        ----------
+        blocked: np.array
+            Boolean n_states x n_states array that indicates which
+            transitions are unsafe.
+        """
+        graph = grid_world_graph((4, 4))
+        safe_set = np.ones((16, 5), dtype=bool)
+        for node, next_node, action in graph.edges(data='action'):
+            safe_set[node, action] = not blocked[node, next_node]
+        link_graph_and_safe_set(graph, safe_set)
+
+        S_hat0 = np.zeros_like(safe_set)
+        S_hat0[5, 0] = True
+        gp = GPy.core.GP(np.zeros((1, 2)), np.zeros((1, 1)),
+                         GPy.kern.RBF(input_dim=2),
+                         GPy.likelihoods.Gaussian())
+        return SafeMDP(graph, gp, S_hat0, 0, 0)
+
+    def _compute_S_hat(self, mdp, parallel):
+        """Run compute_S_hat with or without the parallel search."""
+        default = SafeMDP_class._PARALLEL_SEARCH
+        SafeMDP_class._PARALLEL_SEARCH = parallel
+        try:
+            mdp.compute_S_hat()
+        finally:
+            SafeMDP_class._PARALLEL_SEARCH = default
+
+    def _check(self, blocked):
+        """Compare with the intersection of reachable and returnable set."""
+        mdp = self._mdp(blocked)
+        reach = reachable_set(mdp.graph, [5])
+        true = returnable_set(mdp.graph, None, [5]) & reach
+
+        for parallel in (False, True):
+            mdp.check_symmetry = True
+            self._compute_S_hat(mdp, parallel)
+            assert_equal(mdp.S_hat, true)
+
+            mdp.check_symmetry = False
+            self._compute_S_hat(mdp, parallel)
+            assert_equal(mdp.S_hat, true)
+
+    def test_symmetric(self):
+        """Test safety that is the same in both directions"""
+        blocked = np.random.RandomState(0).rand(16, 16) < 0.3
+        self._check(blocked | blocked.T)
+
+    def test_asymmetric(self):
+        """Test safety that depends on the direction"""
+        blocked = np.random.RandomState(4).rand(16, 16) < 0.3
+        self._check(blocked)
+
+    def test_copy(self):
+        """Test copying an MDP after the sets were computed"""
+        blocked = np.random.RandomState(4).rand(16, 16) < 0.3
+        mdp = self._mdp(blocked)
+        self._compute_S_hat(mdp, True)
+
+        for other in (copy.deepcopy(mdp), pickle.loads(pickle.dumps(mdp))):
+            other.compute_S_hat()
+            assert_equal(other.S_hat, mdp.S_hat)
+
+    def test_relink(self):
+        """Test a graph that is changed and linked again"""
+        graph = grid_world_graph((4, 4))
+        safe_set = np.ones((16, 5), dtype=bool)
+        link_graph_and_safe_set(graph, safe_set)
+
+        S_hat0 = np.zeros_like(safe_set)
+        S_hat0[5, 0] = True
+        mdp = SafeMDP(graph, None, S_hat0, 0, 0)
+        mdp.compute_S_hat()
+
+        # Without the transition from 6 to 5 the graph is not symmetric
+        graph.remove_edge(6, 5)
+        link_graph_and_safe_set(graph, safe_set)
+
+        reach = reachable_set(graph, [5])
+        true = returnable_set(graph, None, [5]) & reach
+
+        mdp.compute_S_hat()
+        assert_equal(mdp.S_hat, true)
 
 
 class GridWorldGraphTest(unittest.TestCase):
@@ -301,7 +501,7 @@ class TestTrueSafeSet(unittest.TestCase):
                               [1, 1, 1, 0, 0, 0],
                               [0, 1, 1, 0, 1, 1],
                               [0, 0, 0, 1, 1, 1]],
-                             dtype=np.bool).T
+                             dtype=bool).T
 
         assert_equal(safe, true_safe)
 
@@ -314,7 +514,7 @@ class TestTrueSafeSet(unittest.TestCase):
                               [1, 0, 1, 0, 0, 0],
                               [0, 1, 1, 0, 1, 0],
                               [0, 0, 0, 1, 1, 0]],
-                             dtype=np.bool).T
+                             dtype=bool).T
         assert_equal(safe, true_safe)
 
 
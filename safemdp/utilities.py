@@ -1,11 +1,15 @@
 from __future__ import division
 
 import numpy as np
-from scipy.interpolate import griddata
+from scipy.interpolate import CloughTocher2DInterpolator
+from scipy.spatial import Delaunay
 import matplotlib.pyplot as plt
 
 __all__ = ['DifferenceKernel', 'max_out_degree']
 
+# Triangulation and mesh of the coordinates last passed to plot_2D
+_plot_2D_cache = {}
+
 
 class DifferenceKernel(object):
     """
@@ -43,8 +47,15 @@ class DifferenceKernel(object):
         if x2 is None:
             x10 = x1[:, :dim]
             x11 = x1[:, dim:]
-            return (self.kern.K(x10) + self.kern.K(x11) -
-                    self.kern.K(x10, x11) - self.kern.K(x11, x10))
+            # Kernels are symmetric, so K(x11, x10) == K(x10, x11).T
+            cross = self.kern.K(x10, x11)
+
+            # Accumulate in place, starting from a new array so that arrays
+            # returned by the kernel are never modified
+            k = self.kern.K(x10) + self.kern.K(x11)
+            k -= cross
+            k -= cross.T
+            return k
         else:
             x20 = x2[:, :dim]
             x21 = x2[:, dim:]
@@ -61,12 +72,62 @@ class DifferenceKernel(object):
         x0 = x[:, :dim]
         x1 = x[:, dim:]
         return (self.kern.Kdiag(x0) + self.kern.Kdiag(x1) -
-                2 * np.diag(self.kern.K(x0, x1)))
+                2 * self._K_pairwise(x0, x1))
+
+    def _K_pairwise(self, x0, x1):
+        """Compute kern.K(x0[i], x1[i]) for all rows i.
+
+        For stationary kernels only the N pairs of points are evaluated,
+        instead of the full N x N matrix.
+
+        Parameters
+        ----------
+        x0: np.array
+        x1: np.array
+        """
+        # GPy.kern.Stationary: k(x, x') = K_of_r(|x - x'| / lengthscale)
+        if hasattr(self.kern, 'K_of_r'):
+            r = np.sqrt(np.sum(np.square((x0 - x1) / self.kern.lengthscale),
+                               axis=1))
+            return self.kern.K_of_r(r)
+        return np.diag(self.kern.K(x0, x1))
+
+
+def _graph_cache(graph, check=True):
+    """Return the dictionary of values that are cached for a graph.
+
+    The cache is kept in `graph.graph`, which copies of the graph and subgraph
+    views share with it. It is started over if it was created for another
+    graph or, if `check` is True, if the number of nodes or edges changed.
+
+    Parameters
+    ----------
+    graph: nx.DiGraph
+    check: bool
+        Whether to count the edges. This costs time linear in the number of
+        nodes, so it is only done once per search.
+
+    Returns
+    -------
+    cache: dict
+    """
+    cache = graph.graph.get('cache')
+    if cache is not None and cache['graph'] is graph and not check:
+        return cache
+
+    # Much faster than graph.number_of_edges()
+    size = (graph.number_of_nodes(), sum(map(len, graph._adj.values())))
+    if cache is None or cache['graph'] is not graph or cache['size'] != size:
+        cache = graph.graph['cache'] = {'graph': graph, 'size': size}
+    return cache
 
 
 def max_out_degree(graph):
     """Compute the maximum out_degree of a graph
 
+    For graphs that are linked to a safe set, the value is cached until the
+    graph changes, see `_graph_cache`.
+
     Parameters
     ----------
     graph: nx.DiGraph
@@ -76,23 +137,36 @@ def max_out_degree(graph):
     max_out_degree: int
         The maximum out_degree of the graph
     """
-    def degree_generator(graph):
-        for _, degree in graph.out_degree():
-            yield degree
-    return max(degree_generator(graph))
+    if 'safe_set' not in graph.graph:
+        return max(dict(graph.out_degree()).values())
+
+    cache = _graph_cache(graph)
+    if 'max_out_degree' not in cache:
+        cache['max_out_degree'] = max(dict(graph.out_degree()).values())
+    return cache['max_out_degree']
 
 
 def plot_2D(coord, altitudes):
-    # Reshape the coordinates and altitudes into a 2D grid
-    x = coord[:, 0]
-    y = coord[:, 1]
-    z = altitudes
+    # The triangulation only depends on the coordinates, reuse it if the
+    # same array is plotted again
+    cached = _plot_2D_cache.get(id(coord))
+    if cached is None or cached[0] is not coord:
+        x = coord[:, 0]
+        y = coord[:, 1]
+
+        xi = np.linspace(x.min(), x.max(), 100)
+        yi = np.linspace(y.min(), y.max(), 100)
+
+        X, Y = np.meshgrid(xi, yi)
+        triangulation = Delaunay(coord[:, :2])
+
+        _plot_2D_cache.clear()
+        _plot_2D_cache[id(coord)] = cached = (coord, triangulation, X, Y)
 
-    xi = np.linspace(x.min(), x.max(), 100)
-    yi = np.linspace(y.min(), y.max(), 100)
+    _, triangulation, X, Y = cached
 
-    X, Y = np.meshgrid(xi, yi)
-    Z = griddata((x, y), z, (X, Y), method='cubic')
+    # Cubic interpolation of the altitudes on a 2D grid
+    Z = CloughTocher2DInterpolator(triangulation, altitudes)(X, Y)
 
     fig, ax = plt.subplots()
     im = ax.pcolormesh(X, Y, Z, cmap='jet')